@@ -3,18 +3,33 @@ ShopLocal Enhanced - E-commerce Platform
 Features: Web App, REST API, Admin Panel, S3 Integration
 """
 
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import FileStorage
 import pymysql
 import os
 import boto3
 from botocore.exceptions import ClientError
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from markupsafe import Markup
 import uuid
 import functools
+import threading
+import random
+import time
+import json
+import sqlite3
+import math
+import hashlib
+import csv
+import io
+import urllib.request
+import heapq
+import itertools
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
@@ -43,7 +58,85 @@ print("USE_S3 =", USE_S3)
 # File upload configuration
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+IMAGE_CONTENT_TYPES = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/gif': 'gif', 'image/webp': 'webp'}
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
+MAX_PRICE = Decimal('100000000')  # products.price is DECIMAL(10, 2)
+MAX_STOCK = 2147483647  # products.stock is INT
+PLACEHOLDER_IMAGE_URL = 'https://via.placeholder.com/400x400?text=Product'
+
+# Rendered-fragment cache (max number of pre-rendered HTML blocks kept in memory)
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 256))
+
+# Stock reservations (in-memory holds committed to MySQL in batches)
+RESERVATION_TTL = int(os.environ.get('RESERVATION_TTL', 600))  # seconds
+RESERVATION_STRIPES = int(os.environ.get('RESERVATION_STRIPES', 8))
+RESERVATION_FLUSH_INTERVAL = float(os.environ.get('RESERVATION_FLUSH_INTERVAL', 1.0))  # seconds
+RESERVATION_FLUSH_BATCH = int(os.environ.get('RESERVATION_FLUSH_BATCH', 500))
+RESERVATION_RECOVERY_HOURS = int(os.environ.get('RESERVATION_RECOVERY_HOURS', 24))  # look-back for unflushed sales
+
+# Background job queue (local SQLite file, no external broker)
+JOB_QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH', 'jobs.sqlite3')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_BASE = float(os.environ.get('JOB_RETRY_BASE', 2.0))  # seconds, doubled per attempt
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 86400))  # seconds to keep completed jobs
+
+# Admission control: (burst capacity, tokens per second) per client IP and route class
+RATE_LIMITS = {
+    'browse': (int(os.environ.get('RATE_LIMIT_BROWSE_BURST', 60)),
+               float(os.environ.get('RATE_LIMIT_BROWSE_RATE', 5.0))),
+    'api': (int(os.environ.get('RATE_LIMIT_API_BURST', 120)),
+            float(os.environ.get('RATE_LIMIT_API_RATE', 10.0))),
+    'order': (int(os.environ.get('RATE_LIMIT_ORDER_BURST', 10)),
+              float(os.environ.get('RATE_LIMIT_ORDER_RATE', 0.5)))
+}
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', 10000))
+RATE_LIMIT_TRUST_PROXY = os.environ.get('RATE_LIMIT_TRUST_PROXY', '').lower() in ('1', 'true', 'yes')
+DB_MAX_CONCURRENCY = int(os.environ.get('DB_MAX_CONCURRENCY', 20))
+DB_MAX_QUEUE = int(os.environ.get('DB_MAX_QUEUE', 50))
+DB_MAX_WAIT = float(os.environ.get('DB_MAX_WAIT', 2.0))  # seconds
+DB_WAIT_SHED_THRESHOLD = float(os.environ.get('DB_WAIT_SHED_THRESHOLD', 0.5))  # seconds
+
+# Idempotency-Key support for API writes
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))  # seconds a response is replayable
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 10000))
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 10.0))  # seconds a duplicate waits for the original
+
+# Bulk exports (rows fetched per round trip from the server-side cursor)
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 1000))
+
+# Bulk catalog import
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 500))
+IMAGE_FETCH_TIMEOUT = int(os.environ.get('IMAGE_FETCH_TIMEOUT', 15))  # seconds
+
+# Warehouse stock sync (changed rows applied per statement)
+STOCK_SYNC_BATCH_SIZE = int(os.environ.get('STOCK_SYNC_BATCH_SIZE', 500))
+
+# Trending products (sliding window of time buckets, decayed per bucket)
+TRENDING_BUCKET_SECONDS = int(os.environ.get('TRENDING_BUCKET_SECONDS', 300))
+TRENDING_BUCKETS = int(os.environ.get('TRENDING_BUCKETS', 24))  # window = buckets x bucket seconds
+TRENDING_DECAY = float(os.environ.get('TRENDING_DECAY', 0.85))
+TRENDING_TOP_K = int(os.environ.get('TRENDING_TOP_K', 10))
+TRENDING_HOME_COUNT = int(os.environ.get('TRENDING_HOME_COUNT', 4))
+TRENDING_REFRESH_SECONDS = int(os.environ.get('TRENDING_REFRESH_SECONDS', 30))
+TRENDING_PERSIST_INTERVAL = int(os.environ.get('TRENDING_PERSIST_INTERVAL', 300))  # seconds
+TRENDING_PURCHASE_WEIGHT = int(os.environ.get('TRENDING_PURCHASE_WEIGHT', 5))  # views per unit sold
+
+# product_views rollups and retention
+HLL_PRECISION = 10  # 1024 registers, ~3% error on unique sessions
+ROLLUP_MAX_HOURS_PER_RUN = int(os.environ.get('ROLLUP_MAX_HOURS_PER_RUN', 48))
+VIEW_RETENTION_DAYS = int(os.environ.get('VIEW_RETENTION_DAYS', 90))
+VIEW_RETENTION_ARCHIVE = os.environ.get('VIEW_RETENTION_ARCHIVE', '').lower() in ('1', 'true', 'yes')
+VIEW_RETENTION_CHUNK = int(os.environ.get('VIEW_RETENTION_CHUNK', 1000))  # rows per delete
+VIEW_RETENTION_PAUSE = float(os.environ.get('VIEW_RETENTION_PAUSE', 0.5))  # seconds between chunks
+VIEW_RETENTION_WINDOW = tuple(map(int, os.environ.get('VIEW_RETENTION_HOURS', '1-6').split('-')))  # off-peak, may wrap midnight
+VIEW_RETENTION_HOURS = {hour % 24 for hour in range(VIEW_RETENTION_WINDOW[0], VIEW_RETENTION_WINDOW[1] +
+                                                    (24 if VIEW_RETENTION_WINDOW[1] < VIEW_RETENTION_WINDOW[0] else 0))}
+VIEW_RETENTION_MAX_RUNTIME = int(os.environ.get('VIEW_RETENTION_MAX_RUNTIME', 3000))  # seconds per run, under the hourly schedule
+
+# Live admin event stream (server-sent events)
+EVENT_HISTORY_SIZE = int(os.environ.get('EVENT_HISTORY_SIZE', 1000))  # events kept for Last-Event-ID resume
+SSE_KEEPALIVE = int(os.environ.get('SSE_KEEPALIVE', 15))  # seconds
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -118,6 +211,15 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def admin_api_required(f):
+    """Decorator to require admin login on JSON API routes"""
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'admin_id' not in session:
+            return jsonify({'success': False, 'error': 'Admin login required'}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
 def generate_order_number():
     """Generate unique order number"""
     timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
@@ -129,10 +231,11 @@ def update_inventory(product_id, quantity_change, change_type, reference_type=No
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Get current stock
-    cursor.execute('SELECT stock FROM products WHERE id = %s', (product_id,))
+    # Lock the row so the batch flusher and concurrent admins cannot interleave with this write
+    cursor.execute('SELECT stock, name, low_stock_threshold FROM products WHERE id = %s FOR UPDATE', (product_id,))
     result = cursor.fetchone()
     if not result:
+        conn.rollback()
         conn.close()
         return False
     
@@ -140,6 +243,7 @@ def update_inventory(product_id, quantity_change, change_type, reference_type=No
     new_stock = previous_stock + quantity_change
     
     if new_stock < 0:
+        conn.rollback()
         conn.close()
         return False
     
@@ -164,35 +268,1470 @@ def update_inventory(product_id, quantity_change, change_type, reference_type=No
     
     conn.commit()
     conn.close()
+    stock_reservations.adjust(product_id, quantity_change)
+    threshold = result['low_stock_threshold']
+    if stock_badge(previous_stock, threshold) != stock_badge(new_stock, threshold):
+        bump_catalog_version()
+    publish_stock_change(product_id, result['name'], previous_stock, new_stock, result['low_stock_threshold'])
     return True
 
+def parse_export_range(args):
+    """Read optional start/end dates (YYYY-MM-DD, end inclusive) from query args"""
+    start = args.get('start')
+    end = args.get('end')
+    start = datetime.strptime(start, '%Y-%m-%d') if start else None
+    end = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else None
+    return start, end
+
+def csv_safe(value):
+    """Neutralise cells a spreadsheet would evaluate as a formula"""
+    if isinstance(value, str) and value.startswith(('=', '+', '-', '@', '\t', '\r')):
+        return "'" + value
+    return value
+
+def stream_export(query, params, columns, fmt, filename):
+    """Stream query rows as CSV or NDJSON through an unbuffered server-side cursor"""
+    def generate():
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor(pymysql.cursors.SSDictCursor)
+            cursor.execute(query, params)
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            if fmt == 'csv':
+                writer.writerow(columns)
+            while True:
+                rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+                if not rows:
+                    break
+                for row in rows:
+                    if fmt == 'csv':
+                        writer.writerow([csv_safe(row[column]) for column in columns])
+                    else:
+                        buffer.write(json.dumps(row, default=str) + '\n')
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue()
+        finally:
+            conn.close()
+    
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(generate(), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={filename}.{fmt}',
+        'X-Accel-Buffering': 'no'
+    })
+
+# ============================================================================
+# EVENT BUS (Live admin updates)
+# ============================================================================
+
+class EventBus:
+    """In-process publish/subscribe with a bounded replay history
+
+    Ids start from the boot time in milliseconds, so ids remembered by a client
+    from before a restart fall outside the history and trigger a reset.
+    """
+
+    def __init__(self, history):
+        self._events = deque(maxlen=history)
+        self._next_id = int(time.time() * 1000)
+        self._condition = threading.Condition()
+
+    @property
+    def last_id(self):
+        return self._next_id - 1
+
+    def publish(self, event_type, data):
+        with self._condition:
+            self._events.append((self._next_id, event_type, json.dumps(data, default=str)))
+            self._next_id += 1
+            self._condition.notify_all()
+
+    def wait(self, last_id, timeout):
+        """Events after last_id, blocking up to timeout; None if last_id is no longer replayable"""
+        with self._condition:
+            if last_id >= self._next_id - 1:
+                self._condition.wait(timeout)
+            if last_id > self._next_id - 1:
+                return None
+            first_id = self._events[0][0] if self._events else self._next_id
+            if last_id < first_id - 1:
+                return None
+            return list(itertools.islice(self._events, last_id - first_id + 1, None))
+
+event_bus = EventBus(EVENT_HISTORY_SIZE)
+
+def publish_order_event(order_id, order_number, customer_name, customer_email, customer_phone, total):
+    """Announce a newly placed order to live admin screens"""
+    event_bus.publish('order', {
+        'id': order_id,
+        'order_number': order_number,
+        'customer_name': customer_name,
+        'customer_email': customer_email,
+        'customer_phone': customer_phone,
+        'total_amount': float(total),
+        'status': 'confirmed',
+        'payment_status': 'paid',
+        'created_at': datetime.now().isoformat(timespec='seconds')
+    })
+
+def publish_stock_change(product_id, name, previous_stock, new_stock, low_stock_threshold):
+    """Announce a committed stock change, plus a low_stock event when it crosses the threshold"""
+    data = {
+        'product_id': product_id,
+        'name': name,
+        'previous_stock': previous_stock,
+        'new_stock': new_stock,
+        'low_stock_threshold': low_stock_threshold
+    }
+    event_bus.publish('stock', data)
+    if previous_stock > low_stock_threshold >= new_stock:
+        event_bus.publish('low_stock', data)
+
+# ============================================================================
+# ADMISSION CONTROL
+# ============================================================================
+
+class RateLimiter:
+    """Per-client token buckets, one per route class, in a bounded LRU map"""
+
+    def __init__(self, limits, max_keys):
+        self.limits = limits
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, client, route_class):
+        """Take one token; returns 0 if allowed, else seconds until a token is available"""
+        capacity, refill_rate = self.limits[route_class]
+        key = (client, route_class)
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * refill_rate)
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0
+            else:
+                retry_after = (1 - tokens) / refill_rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+class ConcurrencyLimiter:
+    """Caps in-flight DB-bound requests and sheds load when the wait queue backs up"""
+
+    def __init__(self, max_concurrent, max_queue, max_wait, wait_threshold):
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.wait_threshold = wait_threshold
+        self._slots = threading.Semaphore(max_concurrent)
+        self._waiting = 0
+        self._avg_wait = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for a slot; returns False if the request should be shed"""
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                return False
+            if self._waiting > 0 and self._avg_wait > self.wait_threshold:
+                return False
+            self._waiting += 1
+        
+        start = time.monotonic()
+        acquired = self._slots.acquire(timeout=self.max_wait)
+        waited = time.monotonic() - start
+        
+        with self._lock:
+            self._waiting -= 1
+            self._avg_wait = 0.9 * self._avg_wait + 0.1 * waited
+        return acquired
+
+    def release(self):
+        self._slots.release()
+
+    @property
+    def retry_after(self):
+        return max(self._avg_wait, 1)
+
+rate_limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_MAX_CLIENTS)
+db_admission = ConcurrencyLimiter(DB_MAX_CONCURRENCY, DB_MAX_QUEUE, DB_MAX_WAIT, DB_WAIT_SHED_THRESHOLD)
+
+def client_ip():
+    """Client address used for rate limiting"""
+    if RATE_LIMIT_TRUST_PROXY and request.access_route:
+        # The load balancer appends the address it saw as the last hop
+        return request.access_route[-1]
+    return request.remote_addr
+
+def shed_response(status, message, retry_after):
+    """429/503 response with a Retry-After header"""
+    if request.path.startswith('/api/'):
+        response = jsonify({'success': False, 'error': message})
+    else:
+        response = app.response_class(message, mimetype='text/plain')
+    response.status_code = status
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response
+
+def admission_controlled(route_class):
+    """Decorator applying per-client rate limits and the global DB concurrency limit"""
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            retry_after = rate_limiter.consume(client_ip(), route_class)
+            if retry_after:
+                return shed_response(429, 'Too many requests, please slow down', retry_after)
+            if not db_admission.acquire():
+                return shed_response(503, 'Server busy, please retry shortly', db_admission.retry_after)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                db_admission.release()
+        return decorated_function
+    return decorator
+
+# ============================================================================
+# IDEMPOTENCY KEYS
+# ============================================================================
+
+class IdempotencyStore:
+    """Bounded TTL map of Idempotency-Key -> in-flight or completed response"""
+
+    def __init__(self, ttl, max_keys):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def begin(self, key, fingerprint):
+        """Returns (entry, owner); the owner executes the request, others wait on entry['done']"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires_at'] > now:
+                self._entries.move_to_end(key)
+                return entry, False
+            
+            entry = {
+                'fingerprint': fingerprint,
+                'done': threading.Event(),
+                'response': None,
+                'expires_at': now + self.ttl
+            }
+            self._entries[key] = entry
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+            return entry, True
+
+    def complete(self, entry, response):
+        """Store the response for replay"""
+        entry['response'] = response
+        entry['done'].set()
+
+    def abandon(self, key, entry):
+        """Forget a failed execution so the next retry runs it again"""
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry['done'].set()
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_KEYS)
+
+def idempotent(f):
+    """Decorator honouring the Idempotency-Key header on JSON API writes"""
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return f(*args, **kwargs)
+        
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT
+        while True:
+            entry, owner = idempotency_store.begin(key, fingerprint)
+            if entry['fingerprint'] != fingerprint:
+                return jsonify({'success': False,
+                                'error': 'Idempotency-Key was already used with a different request'}), 422
+            if owner:
+                break
+            
+            # A duplicate is in flight: wait for it and replay its response
+            if not entry['done'].wait(max(deadline - time.monotonic(), 0)):
+                return shed_response(409, 'A request with this Idempotency-Key is still in progress', 1)
+            if entry['response'] is not None:
+                data, status, mimetype = entry['response']
+                response = app.response_class(data, status=status, mimetype=mimetype)
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+        
+        try:
+            response = app.make_response(f(*args, **kwargs))
+        except Exception:
+            idempotency_store.abandon(key, entry)
+            raise
+        
+        # Server-side failures (including load shedding) are not cached so the client can retry
+        if response.status_code >= 500 or response.status_code == 429:
+            idempotency_store.abandon(key, entry)
+        else:
+            idempotency_store.complete(entry, (response.get_data(), response.status_code, response.mimetype))
+        return response
+    return decorated_function
+
+# ============================================================================
+# FRAGMENT CACHE
+# ============================================================================
+
+class FragmentCache:
+    """Thread-safe LRU cache of rendered template fragments"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._items.get(key)
+            if html is not None:
+                self._items.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        with self._lock:
+            self._items[key] = html
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_SIZE)
+
+# Bumped on catalog writes that change rendered output, so stale fragments simply stop being looked up
+_catalog_version = 0
+_catalog_version_lock = threading.Lock()
+
+def get_catalog_version():
+    """Current catalog version, used in fragment cache keys"""
+    return _catalog_version
+
+def bump_catalog_version():
+    """Invalidate cached fragments after products or stock change"""
+    global _catalog_version
+    with _catalog_version_lock:
+        _catalog_version += 1
+
+def stock_badge(stock, low_stock_threshold):
+    """Stock badge shown on product cards; fragments only go stale when this changes"""
+    if stock <= 0:
+        return 'out_of_stock'
+    if stock <= low_stock_threshold:
+        return 'low_stock'
+    return None
+
+def cached_fragment(key, template, load_context):
+    """Return pre-rendered HTML for key; load_context() is only called on a miss"""
+    html = fragment_cache.get(key)
+    if html is None:
+        html = Markup(render_template(template, **load_context()))
+        fragment_cache.set(key, html)
+    return html
+
+# ============================================================================
+# STOCK RESERVATIONS
+# ============================================================================
+
+class StripedCounter:
+    """Available stock for one product, split across independently locked stripes"""
+
+    def __init__(self, stock, stripes):
+        per_stripe, extra = divmod(max(stock, 0), stripes)
+        self._values = [per_stripe + (1 if i < extra else 0) for i in range(stripes)]
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        # Units owed by a shrink larger than the stripes held; paid off before any stripe grows
+        self._deficit = max(-stock, 0)
+        self._deficit_lock = threading.Lock()
+
+    def take(self, quantity):
+        """Take quantity from the stripes, starting at a random one; all or nothing"""
+        start = random.randrange(len(self._values))
+        taken = []
+        remaining = quantity
+        for offset in range(len(self._values)):
+            i = (start + offset) % len(self._values)
+            with self._locks[i]:
+                amount = min(self._values[i], remaining)
+                if amount > 0:
+                    self._values[i] -= amount
+                    taken.append((i, amount))
+                    remaining -= amount
+            if remaining == 0:
+                return True
+        for i, amount in taken:
+            with self._locks[i]:
+                self._values[i] += amount
+        return False
+
+    def give(self, quantity):
+        """Return quantity to a random stripe; negative values drain stripes, never below zero"""
+        if quantity < 0:
+            self._shrink(-quantity)
+            return
+        with self._deficit_lock:
+            paid = min(self._deficit, quantity)
+            self._deficit -= paid
+        if quantity > paid:
+            i = random.randrange(len(self._values))
+            with self._locks[i]:
+                self._values[i] += quantity - paid
+
+    def _shrink(self, quantity):
+        """Remove quantity across the stripes, clamping each at zero and owing any remainder"""
+        start = random.randrange(len(self._values))
+        remaining = quantity
+        for offset in range(len(self._values)):
+            i = (start + offset) % len(self._values)
+            with self._locks[i]:
+                amount = min(self._values[i], remaining)
+                self._values[i] -= amount
+                remaining -= amount
+            if remaining == 0:
+                return
+        with self._deficit_lock:
+            self._deficit += remaining
+
+class StockReservations:
+    """Short-lived stock holds served from memory, confirmed sales flushed to MySQL in batches
+
+    Counters are seeded from products.stock on first use and kept in step with
+    admin adjustments through adjust(). The committed order_items rows are the
+    durable record of a sale: on start-up any recent item without a matching
+    inventory_log sale row is re-queued and its product's counter seeded net of
+    it, so a crash between checkout and flush cannot lose the decrement.
+
+    Requires a single application process: separate instances would each seed
+    from the same stock and sell it twice, and a starting instance would re-queue
+    sales another live instance has not flushed yet. Flushes floor stock at zero
+    and log any shortfall, so a misconfigured deployment oversells visibly
+    instead of driving stock negative.
+    """
+
+    def __init__(self, ttl, stripes, flush_interval, flush_batch, recovery_hours):
+        self.ttl = ttl
+        self.stripes = stripes
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.recovery_hours = recovery_hours
+        self._counters = {}
+        self._holds = {}
+        self._confirmed = []
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._worker = None
+
+    def _counter(self, product_id):
+        with self._lock:
+            counter = self._counters.get(product_id)
+        if counter is not None:
+            return counter
+        
+        # Sales are only queued against loaded counters (recovered ones are seeded in
+        # _recover), so stock read here never has an unflushed sale to subtract
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT stock FROM products WHERE id = %s', (product_id,))
+        result = cursor.fetchone()
+        conn.close()
+        if not result:
+            return None
+        
+        with self._lock:
+            return self._counters.setdefault(product_id, StripedCounter(result['stock'], self.stripes))
+
+    def _queue_sale(self, product_id, quantity, order_id, notes):
+        self._confirmed.append({
+            'product_id': product_id,
+            'quantity': quantity,
+            'order_id': order_id,
+            'notes': notes
+        })
+
+    def _recover(self):
+        """Re-queue committed order items whose sale never reached inventory_log"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT oi.order_id, oi.product_id, oi.quantity, o.order_number
+                FROM order_items oi
+                JOIN orders o ON oi.order_id = o.id
+                LEFT JOIN inventory_log il ON il.product_id = oi.product_id
+                    AND il.reference_type = 'order' AND il.reference_id = oi.order_id
+                    AND il.change_type = 'sale'
+                WHERE il.id IS NULL AND oi.product_id IS NOT NULL
+                  AND o.created_at >= NOW() - INTERVAL %s HOUR
+                ORDER BY oi.order_id
+            ''', (self.recovery_hours,))
+            rows = cursor.fetchall()
+            pending = {}
+            for row in rows:
+                pending[row['product_id']] = pending.get(row['product_id'], 0) + row['quantity']
+            stock = {}
+            if pending:
+                placeholders = ', '.join(['%s'] * len(pending))
+                cursor.execute(f'SELECT id, stock FROM products WHERE id IN ({placeholders})', list(pending))
+                stock = {row['id']: row['stock'] for row in cursor.fetchall()}
+        finally:
+            conn.close()
+        
+        # No flush has run yet, so products.stock still includes every recovered sale
+        with self._lock:
+            for product_id, current in stock.items():
+                self._counters[product_id] = StripedCounter(current - pending[product_id], self.stripes)
+            for row in rows:
+                self._queue_sale(row['product_id'], row['quantity'], row['order_id'],
+                                 f"Order {row['order_number']} (recovered)")
+        if rows:
+            print(f"Recovered {len(rows)} unflushed sales")
+
+    def reserve(self, product_id, quantity):
+        """Hold quantity units; returns a reservation id or None if not available"""
+        self._ensure_worker()
+        product_id = int(product_id)
+        counter = self._counter(product_id)
+        if quantity <= 0 or counter is None or not counter.take(quantity):
+            return None
+        
+        reservation_id = uuid.uuid4().hex
+        with self._lock:
+            self._holds[reservation_id] = {
+                'product_id': product_id,
+                'quantity': quantity,
+                'expires_at': time.monotonic() + self.ttl
+            }
+        return reservation_id
+
+    def claim(self, reservation_id, product_id, quantity):
+        """Reuse a live hold matching product and quantity, otherwise reserve afresh"""
+        with self._lock:
+            hold = self._holds.get(reservation_id)
+            if hold and hold['product_id'] == int(product_id) and hold['quantity'] == quantity:
+                hold['expires_at'] = time.monotonic() + self.ttl
+                return reservation_id
+        self.release(reservation_id)
+        return self.reserve(product_id, quantity)
+
+    def release(self, reservation_id):
+        """Give a held quantity back to the counter"""
+        with self._lock:
+            hold = self._holds.pop(reservation_id, None)
+            counter = self._counters.get(hold['product_id']) if hold else None
+        if counter is not None:
+            counter.give(hold['quantity'])
+
+    def confirm(self, reservation_id, order_id, notes=None):
+        """Turn a hold into a sale; the stock write is queued for the next batch"""
+        with self._lock:
+            hold = self._holds.pop(reservation_id, None)
+            if not hold:
+                return False
+            self._queue_sale(hold['product_id'], hold['quantity'], order_id, notes)
+        return True
+
+    def adjust(self, product_id, quantity_change):
+        """Apply a stock change made directly in the database to a loaded counter"""
+        with self._lock:
+            counter = self._counters.get(int(product_id))
+        if counter is not None:
+            counter.give(quantity_change)
+
+    def expire_holds(self):
+        """Release holds whose checkout was abandoned"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [rid for rid, hold in self._holds.items() if hold['expires_at'] <= now]
+        for reservation_id in expired:
+            self.release(reservation_id)
+        return len(expired)
+
+    def flush(self):
+        """Commit a batch of confirmed reservations to MySQL in one transaction"""
+        with self._lock:
+            batch = self._confirmed[:self.flush_batch]
+            del self._confirmed[:self.flush_batch]
+        if not batch:
+            return 0
+        
+        product_ids = sorted({item['product_id'] for item in batch})
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT id, stock, name, low_stock_threshold FROM products
+                WHERE id IN ({placeholders}) FOR UPDATE
+            ''', product_ids)
+            products = {row['id']: row for row in cursor.fetchall()}
+            stock = {product_id: product['stock'] for product_id, product in products.items()}
+            
+            # Rows are locked, so flooring here is the same as a conditional stock >= quantity update;
+            # a shortfall means another writer sold the same units and is logged rather than applied
+            log_rows = []
+            shortfalls = {}
+            for item in batch:
+                if item['product_id'] not in stock:
+                    print(f"Dropping sale for missing product {item['product_id']} (order {item['order_id']})")
+                    continue
+                previous_stock = stock[item['product_id']]
+                new_stock = max(previous_stock - item['quantity'], 0)
+                shortfall = item['quantity'] - (previous_stock - new_stock)
+                notes = item['notes']
+                if shortfall:
+                    shortfalls[item['product_id']] = shortfalls.get(item['product_id'], 0) + shortfall
+                    notes = f"{notes or ''} (oversold by {shortfall})".strip()
+                stock[item['product_id']] = new_stock
+                log_rows.append((item['product_id'], 'sale', new_stock - previous_stock, previous_stock, new_stock,
+                                 'order', item['order_id'], notes, None))
+            
+            cursor.executemany('''
+                INSERT INTO inventory_log 
+                (product_id, change_type, quantity_change, previous_stock, new_stock, 
+                 reference_type, reference_id, notes, created_by)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ''', log_rows)
+            cursor.executemany('''
+                UPDATE products SET stock = %s, status = IF(%s <= 0, 'out_of_stock', status)
+                WHERE id = %s
+            ''', [(new_stock, new_stock, product_id) for product_id, new_stock in stock.items()])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            with self._lock:
+                self._confirmed[:0] = batch
+            print(f"Reservation flush error: {e}")
+            return 0
+        finally:
+            conn.close()
+        
+        for product_id, shortfall in shortfalls.items():
+            print(f"Oversold product {product_id} by {shortfall}; stock floored at 0")
+            self.adjust(product_id, -shortfall)
+        
+        # Sales only invalidate cached grids when a low/out-of-stock badge appears
+        if any(stock_badge(product['stock'], product['low_stock_threshold'])
+               != stock_badge(stock[product_id], product['low_stock_threshold'])
+               for product_id, product in products.items()):
+            bump_catalog_version()
+        for product_id, product in products.items():
+            publish_stock_change(product_id, product['name'], product['stock'], stock[product_id],
+                                 product['low_stock_threshold'])
+        return len(batch)
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._start_lock:
+            if self._worker is None:
+                # Recover before any counter is seeded so pending sales are subtracted
+                self._recover()
+                self._worker = threading.Thread(target=self._run, name='stock-reservations', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.expire_holds()
+                while self.flush() == self.flush_batch:
+                    pass
+            except Exception as e:
+                print(f"Reservation worker error: {e}")
+
+stock_reservations = StockReservations(RESERVATION_TTL, RESERVATION_STRIPES,
+                                       RESERVATION_FLUSH_INTERVAL, RESERVATION_FLUSH_BATCH,
+                                       RESERVATION_RECOVERY_HOURS)
+
+def reserve_cart(cart):
+    """Hold stock for every cart line; returns {product_id: reservation_id} for lines that fit"""
+    held = session.get('reservations', {})
+    reservations = {}
+    for product_id, quantity in cart.items():
+        reservation_id = stock_reservations.claim(held.get(product_id), product_id, quantity)
+        if reservation_id:
+            reservations[product_id] = reservation_id
+    for product_id, reservation_id in held.items():
+        if product_id not in cart:
+            stock_reservations.release(reservation_id)
+    session['reservations'] = reservations
+    return reservations
+
+def release_cart_reservation(product_id):
+    """Drop the hold for a cart line that was removed or changed"""
+    reservations = session.get('reservations', {})
+    reservation_id = reservations.pop(product_id, None)
+    if reservation_id:
+        stock_reservations.release(reservation_id)
+        session['reservations'] = reservations
+
+# ============================================================================
+# BACKGROUND JOB QUEUE
+# ============================================================================
+
+class JobQueue:
+    """Durable SQLite-backed job queue processed by a pool of worker threads
+
+    Jobs are delivered at least once (a crash mid-job re-runs it on restart),
+    so every handler must be idempotent.
+    """
+
+    def __init__(self, path, workers, max_attempts, retry_base, retention, poll_interval=1.0):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self._last_purge = 0
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._schedules = []
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                dedupe_key TEXT UNIQUE,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL
+            )
+        ''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (status, run_at)')
+        # Jobs interrupted by a restart go back to the queue
+        self._db.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+
+    def handler(self, name):
+        """Decorator registering the function that runs jobs called name"""
+        def decorator(f):
+            self._handlers[name] = f
+            return f
+        return decorator
+
+    def enqueue(self, name, payload, dedupe_key=None):
+        """Persist a job; a repeated dedupe_key is ignored"""
+        now = time.time()
+        with self._lock:
+            self._db.execute('''
+                INSERT OR IGNORE INTO jobs (name, payload, dedupe_key, run_at, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (name, json.dumps(payload), dedupe_key, now, now))
+        self.start()
+        self._wakeup.set()
+
+    def every(self, interval, name, payload=None):
+        """Enqueue a job once per interval seconds (one job per period via its dedupe key)"""
+        self._schedules.append((interval, name, payload or {}))
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._run_schedules, name='job-scheduler', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run_schedules(self):
+        while True:
+            now = time.time()
+            for interval, name, payload in self._schedules:
+                self.enqueue(name, payload, dedupe_key=f'{name}:{int(now // interval)}')
+            time.sleep(min([interval for interval, _, _ in self._schedules] + [60]))
+
+    def _claim(self):
+        with self._lock:
+            row = self._db.execute('''
+                SELECT id, name, payload, attempts FROM jobs
+                WHERE status = 'pending' AND run_at <= ?
+                ORDER BY run_at LIMIT 1
+            ''', (time.time(),)).fetchone()
+            if not row:
+                return None
+            self._db.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1 WHERE id = ?",
+                             (row[0],))
+            return {'id': row[0], 'name': row[1], 'payload': json.loads(row[2]), 'attempts': row[3] + 1}
+
+    def _finish(self, job, error=None):
+        with self._lock:
+            if error is None:
+                self._db.execute("UPDATE jobs SET status = 'done', last_error = NULL WHERE id = ?",
+                                 (job['id'],))
+            elif job['attempts'] >= self.max_attempts:
+                self._db.execute("UPDATE jobs SET status = 'failed', last_error = ? WHERE id = ?",
+                                 (error, job['id']))
+            else:
+                delay = self.retry_base ** job['attempts'] * random.uniform(0.5, 1.5)
+                self._db.execute('''
+                    UPDATE jobs SET status = 'pending', run_at = ?, last_error = ? WHERE id = ?
+                ''', (time.time() + delay, error, job['id']))
+
+    def purge(self):
+        """Delete completed jobs past the retention window"""
+        with self._lock:
+            self._last_purge = time.time()
+            self._db.execute("DELETE FROM jobs WHERE status = 'done' AND created_at < ?",
+                             (self._last_purge - self.retention,))
+
+    def _run(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                if time.time() - self._last_purge > 3600:
+                    self.purge()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            
+            handler = self._handlers.get(job['name'])
+            try:
+                if handler is None:
+                    raise LookupError(f"No handler registered for job {job['name']}")
+                handler(**job['payload'])
+                self._finish(job)
+            except Exception as e:
+                print(f"Job {job['name']} #{job['id']} failed (attempt {job['attempts']}): {e}")
+                self._finish(job, str(e))
+
+job_queue = JobQueue(JOB_QUEUE_PATH, JOB_WORKERS, JOB_MAX_ATTEMPTS, JOB_RETRY_BASE, JOB_RETENTION)
+
+@job_queue.handler('record_purchases')
+def record_purchases(order_id):
+    """Add an order's quantities to purchase counts once (marked in purchase_counted_orders, so safe to re-run)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        # The marker and the increment commit together; a retry after success finds the marker
+        cursor.execute('INSERT IGNORE INTO purchase_counted_orders (order_id) VALUES (%s)', (order_id,))
+        if cursor.rowcount:
+            cursor.execute('''
+                UPDATE products p
+                INNER JOIN (
+                    SELECT product_id, SUM(quantity) AS sold FROM order_items
+                    WHERE order_id = %s
+                    GROUP BY product_id
+                ) s ON p.id = s.product_id
+                SET p.purchases = p.purchases + s.sold
+            ''', (order_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+# ============================================================================
+# BULK CATALOG IMPORT
+# ============================================================================
+
+def parse_import_file(file):
+    """Read product rows from an uploaded CSV or JSON file"""
+    content = file.read().decode('utf-8-sig')
+    if file.filename.lower().endswith('.json'):
+        data = json.loads(content)
+        return data.get('products', []) if isinstance(data, dict) else data
+    return list(csv.DictReader(io.StringIO(content)))
+
+def validate_import_row(row):
+    """Normalise one import row; returns (product, errors)"""
+    errors = []
+    if not isinstance(row, dict):
+        return None, ['Row must be an object']
+    
+    name = str(row.get('name') or '').strip()
+    if not name:
+        errors.append('name is required')
+    elif len(name) > 200:
+        errors.append('name must be at most 200 characters')
+    
+    category = str(row.get('category') or '').strip()
+    if len(category) > 100:
+        errors.append('category must be at most 100 characters')
+    
+    description = str(row.get('description') or '')
+    if len(description.encode('utf-8')) > 65535:
+        errors.append('description must be at most 65535 bytes')
+    
+    try:
+        price = Decimal(str(row.get('price')))
+        if not price.is_finite() or price <= 0:
+            errors.append('price must be greater than 0')
+        elif price >= MAX_PRICE or price.quantize(Decimal('0.01')) >= MAX_PRICE:
+            errors.append(f'price must be less than {MAX_PRICE}')
+    except ArithmeticError:
+        errors.append('price must be a number')
+    
+    numbers = {}
+    for field, default in (('stock', 0), ('low_stock_threshold', 10)):
+        value = row.get(field)
+        numbers[field] = parse_whole_number(value) if value not in (None, '') else default
+        if numbers[field] is None:
+            errors.append(f'{field} must be a whole number')
+        elif numbers[field] < 0:
+            errors.append(f'{field} must not be negative')
+        elif numbers[field] > MAX_STOCK:
+            errors.append(f'{field} must be at most {MAX_STOCK}')
+    
+    image_url = str(row.get('image_url') or '').strip()
+    if image_url and not image_url.startswith(('http://', 'https://')):
+        errors.append('image_url must be an http(s) URL')
+    elif len(image_url) > 500:
+        errors.append('image_url must be at most 500 characters')
+    
+    if errors:
+        return None, errors
+    return {
+        'name': name,
+        'description': description,
+        'price': price,
+        'stock': numbers['stock'],
+        'category': category,
+        'image_url': image_url,
+        'low_stock_threshold': numbers['low_stock_threshold']
+    }, []
+
+def import_products(rows, admin_id=None):
+    """Validate all rows, then insert valid products and their initial stock log in batches"""
+    products = []
+    errors = []
+    for row_number, row in enumerate(rows, start=1):
+        product, row_errors = validate_import_row(row)
+        if row_errors:
+            errors.append({'row': row_number, 'errors': row_errors})
+        else:
+            products.append(product)
+    
+    if not products:
+        return {'imported': 0, 'errors': errors}
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    image_jobs = []
+    try:
+        for start in range(0, len(products), IMPORT_BATCH_SIZE):
+            batch = products[start:start + IMPORT_BATCH_SIZE]
+            # One multi-row statement per batch; lastrowid is the first new id
+            placeholders = ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * len(batch))
+            values = []
+            for product in batch:
+                values.extend([product['name'], product['description'], product['price'], product['stock'],
+                               product['category'], product['image_url'] or PLACEHOLDER_IMAGE_URL,
+                               product['low_stock_threshold'],
+                               'active' if product['stock'] > 0 else 'out_of_stock'])
+            cursor.execute(f'''
+                INSERT INTO products (name, description, price, stock, category, image_url, low_stock_threshold, status)
+                VALUES {placeholders}
+            ''', values)
+            
+            # Read the ids back rather than assuming they are consecutive (auto_increment_increment,
+            # interleaved lock mode); any row that is not ours aborts the whole import
+            cursor.execute('SELECT id, name FROM products WHERE id >= %s ORDER BY id LIMIT %s',
+                           (cursor.lastrowid, len(batch)))
+            inserted = cursor.fetchall()
+            if [row['name'] for row in inserted] != [product['name'] for product in batch]:
+                raise RuntimeError('imported product ids were not consecutive')
+            
+            log_rows = []
+            for row, product in zip(inserted, batch):
+                product_id = row['id']
+                if product['stock'] > 0:
+                    log_rows.append((product_id, 'stock_in', product['stock'], 0, product['stock'],
+                                     'import', None, 'Initial stock (bulk import)', admin_id))
+                if product['image_url'] and USE_S3:
+                    image_jobs.append((product_id, product['image_url']))
+            if log_rows:
+                cursor.executemany('''
+                    INSERT INTO inventory_log 
+                    (product_id, change_type, quantity_change, previous_stock, new_stock, 
+                     reference_type, reference_id, notes, created_by)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ''', log_rows)
+        conn.commit()
+    except (pymysql.MySQLError, RuntimeError) as e:
+        conn.rollback()
+        print(f"Product import error: {e}")
+        errors.append({'row': 'all', 'errors': [f'Import rolled back, no products were imported: {e}']})
+        return {'imported': 0, 'errors': errors}
+    finally:
+        conn.close()
+    
+    # Remote images are copied to S3 by the job workers, several at a time
+    for product_id, source_url in image_jobs:
+        job_queue.enqueue('import_product_image', {'product_id': product_id, 'source_url': source_url},
+                          dedupe_key=f'import_product_image:{product_id}')
+    
+    bump_catalog_version()
+    return {'imported': len(products), 'errors': errors}
+
+@job_queue.handler('import_product_image')
+def import_product_image(product_id, source_url):
+    """Copy a remote product image to S3 (same key on every attempt, so safe to re-run)"""
+    with urllib.request.urlopen(source_url, timeout=IMAGE_FETCH_TIMEOUT) as remote:
+        content_type = remote.headers.get_content_type()
+        data = remote.read(MAX_FILE_SIZE + 1)
+    if not content_type.startswith('image/') or len(data) > MAX_FILE_SIZE:
+        print(f"Skipping image for product {product_id}: {content_type}, {len(data)} bytes")
+        return
+    
+    extension = IMAGE_CONTENT_TYPES.get(content_type)
+    if extension not in ALLOWED_EXTENSIONS:
+        print(f"Skipping image for product {product_id}: unsupported type {content_type}")
+        return
+    filename = f"import-{product_id}-{hashlib.sha256(source_url.encode()).hexdigest()[:16]}.{extension}"
+    image_url = upload_to_s3(FileStorage(io.BytesIO(data), filename, content_type=content_type), filename)
+    if not image_url:
+        raise RuntimeError(f'S3 upload failed for {source_url}')
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE products SET image_url = %s WHERE id = %s', (image_url, product_id))
+    conn.commit()
+    conn.close()
+    bump_catalog_version()
+
+# ============================================================================
+# WAREHOUSE STOCK SYNC
+# ============================================================================
+
+def parse_whole_number(value):
+    """Strict int parse: real ints or digit strings only, never floats or booleans"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        text = value.strip()
+        digits = text[1:] if text.startswith('-') else text
+        if digits.isascii() and digits.isdigit():
+            return int(text)
+    return None
+
+def parse_stock_feed(feed):
+    """Validate a {product_id: stock} feed; returns (stock_by_id, errors)"""
+    stock_by_id = {}
+    errors = []
+    for product_id, stock in feed.items():
+        parsed_id = parse_whole_number(product_id)
+        parsed_stock = parse_whole_number(stock)
+        if parsed_id is None or parsed_stock is None:
+            errors.append({'product_id': product_id, 'error': 'product_id and stock must be whole numbers'})
+            continue
+        if parsed_stock < 0:
+            errors.append({'product_id': parsed_id, 'error': 'stock must not be negative'})
+            continue
+        stock_by_id[parsed_id] = parsed_stock
+    return stock_by_id, errors
+
+def sync_stock(stock_by_id, admin_id=None):
+    """Apply absolute stock counts, touching only rows whose stock actually changed"""
+    if not stock_by_id:
+        return {'updated': 0, 'unchanged': 0, 'unknown': []}
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        # Diff against current stock in one query
+        product_ids = sorted(stock_by_id)
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        cursor.execute(f'''
+            SELECT id, stock, name, low_stock_threshold FROM products
+            WHERE id IN ({placeholders}) FOR UPDATE
+        ''', product_ids)
+        products = {row['id']: row for row in cursor.fetchall()}
+        current = {product_id: product['stock'] for product_id, product in products.items()}
+        changes = [(product_id, current[product_id], stock) for product_id, stock in stock_by_id.items()
+                   if product_id in current and current[product_id] != stock]
+        
+        for start in range(0, len(changes), STOCK_SYNC_BATCH_SIZE):
+            batch = changes[start:start + STOCK_SYNC_BATCH_SIZE]
+            ids = [product_id for product_id, _, _ in batch]
+            id_placeholders = ', '.join(['%s'] * len(batch))
+            feed_rows = ' UNION ALL '.join(['SELECT %s AS id, %s AS stock'] * len(batch))
+            feed_params = [value for product_id, _, stock in batch for value in (product_id, stock)]
+            
+            cursor.execute(f'''
+                UPDATE products p
+                INNER JOIN ({feed_rows}) feed ON p.id = feed.id
+                SET p.stock = feed.stock
+            ''', feed_params)
+            cursor.execute(f'''
+                UPDATE products SET status = 'out_of_stock'
+                WHERE id IN ({id_placeholders}) AND stock = 0 AND status = 'active'
+            ''', ids)
+            cursor.execute(f'''
+                UPDATE products SET status = 'active'
+                WHERE id IN ({id_placeholders}) AND stock > 0 AND status = 'out_of_stock'
+            ''', ids)
+            cursor.executemany('''
+                INSERT INTO inventory_log 
+                (product_id, change_type, quantity_change, previous_stock, new_stock, 
+                 reference_type, reference_id, notes, created_by)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ''', [(product_id, 'adjustment', stock - previous_stock, previous_stock, stock,
+                   'stock_sync', None, 'Warehouse stock sync', admin_id)
+                  for product_id, previous_stock, stock in batch])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    for product_id, previous_stock, stock in changes:
+        stock_reservations.adjust(product_id, stock - previous_stock)
+        publish_stock_change(product_id, products[product_id]['name'], previous_stock, stock,
+                             products[product_id]['low_stock_threshold'])
+    if any(stock_badge(previous_stock, products[product_id]['low_stock_threshold'])
+           != stock_badge(stock, products[product_id]['low_stock_threshold'])
+           for product_id, previous_stock, stock in changes):
+        bump_catalog_version()
+    
+    return {
+        'updated': len(changes),
+        'unchanged': len(current) - len(changes),
+        'unknown': sorted(set(stock_by_id) - set(current))
+    }
+
+# ============================================================================
+# TRENDING PRODUCTS
+# ============================================================================
+
+class TrendingTracker:
+    """Sliding-window top-K over view and purchase events
+
+    Events land in time buckets; older buckets count for less (decay per
+    bucket) and fall out of the window. The top-K list is rebuilt at most every
+    refresh_seconds, so reads are O(K) no matter how much traffic comes in.
+    """
+
+    def __init__(self, bucket_seconds, num_buckets, decay, k, refresh_seconds, persist_interval):
+        self.bucket_seconds = bucket_seconds
+        self.num_buckets = num_buckets
+        self.decay = decay
+        self.k = k
+        self.refresh_seconds = refresh_seconds
+        self.persist_interval = persist_interval
+        self._buckets = deque()
+        self._top = []
+        self._built_at = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def record(self, product_id, weight=1):
+        self._ensure_worker()
+        now_bucket = int(time.time() // self.bucket_seconds)
+        with self._lock:
+            self._rotate(now_bucket)
+            counts = self._buckets[-1][1]
+            counts[product_id] = counts.get(product_id, 0) + weight
+            self._dirty = True
+
+    def top(self, limit=None):
+        """[(product_id, score), ...] best first"""
+        now = time.time()
+        with self._lock:
+            self._rotate(int(now // self.bucket_seconds))
+            if self._dirty and now - self._built_at >= self.refresh_seconds:
+                self._rebuild(now)
+            return self._top[:limit or self.k]
+
+    def _rotate(self, now_bucket):
+        if not self._buckets or self._buckets[-1][0] != now_bucket:
+            self._buckets.append((now_bucket, {}))
+            while self._buckets[0][0] <= now_bucket - self.num_buckets:
+                self._buckets.popleft()
+            self._dirty = True
+
+    def _rebuild(self, now):
+        now_bucket = self._buckets[-1][0]
+        totals = {}
+        for bucket_id, counts in self._buckets:
+            factor = self.decay ** (now_bucket - bucket_id)
+            for product_id, count in counts.items():
+                totals[product_id] = totals.get(product_id, 0) + count * factor
+        self._top = heapq.nlargest(self.k, totals.items(), key=lambda item: item[1])
+        self._built_at = now
+        self._dirty = False
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='trending-persist', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.persist_interval)
+            top = self.top()
+            if top:
+                job_queue.enqueue('persist_trending', {'items': top},
+                                  dedupe_key=f'persist_trending:{int(time.time() // self.persist_interval)}')
+
+trending_tracker = TrendingTracker(TRENDING_BUCKET_SECONDS, TRENDING_BUCKETS, TRENDING_DECAY,
+                                   TRENDING_TOP_K, TRENDING_REFRESH_SECONDS, TRENDING_PERSIST_INTERVAL)
+
+@job_queue.handler('persist_trending')
+def persist_trending(items):
+    """Replace the 'trending' recommendation rows with a tracker snapshot"""
+    best = items[0][1] if items else 0
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM product_recommendations WHERE recommendation_type = %s', ('trending',))
+    if best > 0:
+        cursor.executemany('''
+            INSERT INTO product_recommendations (product_id, recommended_product_id, score, recommendation_type)
+            VALUES (%s, %s, %s, %s)
+        ''', [(product_id, product_id, round(100 * score / best, 2), 'trending') for product_id, score in items])
+    conn.commit()
+    conn.close()
+
+def get_trending_products(cursor, limit):
+    """Active trending products, best first; falls back to the last persisted snapshot"""
+    product_ids = [product_id for product_id, _ in trending_tracker.top(limit)]
+    if not product_ids:
+        cursor.execute('''
+            SELECT product_id FROM product_recommendations
+            WHERE recommendation_type = %s ORDER BY score DESC LIMIT %s
+        ''', ('trending', limit))
+        product_ids = [row['product_id'] for row in cursor.fetchall()]
+    if not product_ids:
+        return []
+    
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    cursor.execute(f'SELECT * FROM products WHERE id IN ({placeholders}) AND status = %s',
+                   product_ids + ['active'])
+    products = {product['id']: product for product in cursor.fetchall()}
+    return [products[product_id] for product_id in product_ids if product_id in products]
+
+# ============================================================================
+# PRODUCT VIEW ROLLUPS & RETENTION
+# ============================================================================
+
+class HyperLogLog:
+    """Approximate distinct counter; registers merge, so hourly sketches roll up into days"""
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+
+    def add(self, value):
+        x = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+        index = x >> (64 - self.precision)
+        rest = x & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        for i, rank in enumerate(other.registers):
+            if rank > self.registers[i]:
+                self.registers[i] = rank
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            estimate = self.size * math.log(self.size / zeros)
+        return int(round(estimate))
+
+def get_watermark(cursor, name):
+    cursor.execute('SELECT value FROM analytics_watermarks WHERE name = %s', (name,))
+    row = cursor.fetchone()
+    return row['value'] if row else None
+
+def set_watermark(cursor, name, value):
+    cursor.execute('''
+        INSERT INTO analytics_watermarks (name, value) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE value = VALUES(value)
+    ''', (name, value))
+
+def save_rollups(cursor, granularity, bucket_start, stats):
+    """Upsert {product_id: [views, sketch]} for one bucket (recomputed, so safe to re-run)"""
+    cursor.executemany('''
+        INSERT INTO product_view_rollups
+        (product_id, granularity, bucket_start, views, unique_sessions, sessions_sketch)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE views = VALUES(views), unique_sessions = VALUES(unique_sessions),
+                                sessions_sketch = VALUES(sessions_sketch)
+    ''', [(product_id, granularity, bucket_start, views, sketch.count(), bytes(sketch.registers))
+          for product_id, (views, sketch) in stats.items()])
+
+@job_queue.handler('rollup_product_views')
+def rollup_product_views():
+    """Aggregate completed hours of raw views into hourly rows, then refresh their daily rows"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT DATE_FORMAT(NOW(), '%Y-%m-%d %H:00:00') AS hour")
+    current_hour = datetime.strptime(cursor.fetchone()['hour'], '%Y-%m-%d %H:%M:%S')
+    
+    next_hour = get_watermark(cursor, 'product_views_hourly')
+    if next_hour is None:
+        cursor.execute('SELECT MIN(viewed_at) AS first FROM product_views')
+        first = cursor.fetchone()['first']
+        if first is None:
+            conn.close()
+            return
+        next_hour = first.replace(minute=0, second=0, microsecond=0)
+    
+    days = set()
+    hours_done = 0
+    while next_hour < current_hour and hours_done < ROLLUP_MAX_HOURS_PER_RUN:
+        hour_end = next_hour + timedelta(hours=1)
+        stats = {}
+        stream = conn.cursor(pymysql.cursors.SSDictCursor)
+        stream.execute('''
+            SELECT product_id, session_id FROM product_views
+            WHERE viewed_at >= %s AND viewed_at < %s
+        ''', (next_hour, hour_end))
+        for row in stream:
+            entry = stats.setdefault(row['product_id'], [0, HyperLogLog()])
+            entry[0] += 1
+            if row['session_id']:
+                entry[1].add(row['session_id'])
+        stream.close()
+        
+        if stats:
+            save_rollups(cursor, 'hour', next_hour, stats)
+            days.add(next_hour.date())
+        set_watermark(cursor, 'product_views_hourly', hour_end)
+        conn.commit()
+        next_hour = hour_end
+        hours_done += 1
+    
+    for day in days:
+        day_start = datetime.combine(day, datetime.min.time())
+        cursor.execute('''
+            SELECT product_id, views, sessions_sketch FROM product_view_rollups
+            WHERE granularity = 'hour' AND bucket_start >= %s AND bucket_start < %s
+        ''', (day_start, day_start + timedelta(days=1)))
+        stats = {}
+        for row in cursor.fetchall():
+            entry = stats.setdefault(row['product_id'], [0, HyperLogLog()])
+            entry[0] += row['views']
+            entry[1].merge(HyperLogLog(registers=row['sessions_sketch']))
+        save_rollups(cursor, 'day', day_start, stats)
+        # Once the day row is final the hourly sketches are never merged again; keep only the day's
+        if day_start + timedelta(days=1) <= next_hour:
+            cursor.execute('''
+                UPDATE product_view_rollups SET sessions_sketch = NULL
+                WHERE granularity = 'hour' AND bucket_start >= %s AND bucket_start < %s
+            ''', (day_start, day_start + timedelta(days=1)))
+        conn.commit()
+    
+    conn.close()
+
+purge_running = threading.Lock()
+
+@job_queue.handler('purge_product_views')
+def purge_product_views():
+    """Delete (or archive) raw views past retention in small chunks, off-peak only"""
+    if datetime.now().hour not in VIEW_RETENTION_HOURS:
+        return
+    # One purge at a time, so hourly runs never pile up on the job workers
+    if not purge_running.acquire(blocking=False):
+        return
+    try:
+        purge_expired_views(time.monotonic() + VIEW_RETENTION_MAX_RUNTIME)
+    finally:
+        purge_running.release()
+
+def purge_expired_views(deadline):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Never remove views that have not been rolled up yet
+    rolled_up_to = get_watermark(cursor, 'product_views_hourly')
+    if rolled_up_to is None:
+        conn.close()
+        return
+    cursor.execute('SELECT NOW() - INTERVAL %s DAY AS cutoff', (VIEW_RETENTION_DAYS,))
+    cutoff = min(cursor.fetchone()['cutoff'], rolled_up_to)
+    
+    while datetime.now().hour in VIEW_RETENTION_HOURS and time.monotonic() < deadline:
+        cursor.execute('SELECT id FROM product_views WHERE viewed_at < %s ORDER BY viewed_at LIMIT %s',
+                      (cutoff, VIEW_RETENTION_CHUNK))
+        ids = [row['id'] for row in cursor.fetchall()]
+        if not ids:
+            break
+        
+        placeholders = ', '.join(['%s'] * len(ids))
+        if VIEW_RETENTION_ARCHIVE:
+            cursor.execute(f'''
+                INSERT IGNORE INTO product_views_archive (id, product_id, session_id, ip_address, viewed_at)
+                SELECT id, product_id, session_id, ip_address, viewed_at FROM product_views
+                WHERE id IN ({placeholders})
+            ''', ids)
+        cursor.execute(f'DELETE FROM product_views WHERE id IN ({placeholders})', ids)
+        conn.commit()
+        time.sleep(VIEW_RETENTION_PAUSE)
+    
+    conn.close()
+
+job_queue.every(3600, 'rollup_product_views')
+job_queue.every(3600, 'purge_product_views')
+
 # ============================================================================
 # CUSTOMER-FACING ROUTES (Web App)
 # ============================================================================
 
 @app.route('/')
+@admission_controlled('browse')
 def home():
     """Homepage - Display all products"""
+    category = request.args.get('category')
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    category = request.args.get('category')
-    if category:
-        cursor.execute('SELECT * FROM products WHERE category = %s AND status = %s ORDER BY created_at DESC', 
-                      (category, 'active'))
-    else:
-        cursor.execute('SELECT * FROM products WHERE status = %s ORDER BY created_at DESC', ('active',))
+    def load_products():
+        if category:
+            cursor.execute('SELECT * FROM products WHERE category = %s AND status = %s ORDER BY created_at DESC', 
+                          (category, 'active'))
+        else:
+            cursor.execute('SELECT * FROM products WHERE status = %s ORDER BY created_at DESC', ('active',))
+        return {'products': cursor.fetchall()}
     
-    products = cursor.fetchall()
+    product_grid = cached_fragment(('home_grid', category, get_catalog_version()),
+                                   'partials/product_grid.html', load_products)
+    
+    # Trending strip (all-products view only)
+    trending_strip = None
+    if not category:
+        trending_ids = tuple(product_id for product_id, _ in trending_tracker.top(TRENDING_HOME_COUNT))
+        trending_strip = cached_fragment(('trending', trending_ids, get_catalog_version()),
+                                         'partials/trending.html',
+                                         lambda: {'trending': get_trending_products(cursor, TRENDING_HOME_COUNT)})
     
     # Get all categories
     cursor.execute('SELECT DISTINCT category FROM products WHERE status = %s ORDER BY category', ('active',))
     categories = [row['category'] for row in cursor.fetchall()]
     
     conn.close()
-    return render_template('home.html', products=products, categories=categories, current_category=category)
+    return render_template('home.html', product_grid=product_grid, trending_strip=trending_strip,
+                           categories=categories, current_category=category)
 
 @app.route('/product/<int:product_id>')
+@admission_controlled('browse')
 def product_detail(product_id):
     """Product detail page with recommendations"""
     conn = get_db_connection()
@@ -215,23 +1754,29 @@ def product_detail(product_id):
     session['session_id'] = session_id
     cursor.execute('INSERT INTO product_views (product_id, session_id, ip_address) VALUES (%s, %s, %s)',
                   (product_id, session_id, request.remote_addr))
+    trending_tracker.record(product_id)
     
-    # Get recommendations
-    cursor.execute('''
-        SELECT p.* FROM products p
-        INNER JOIN product_recommendations pr ON p.id = pr.recommended_product_id
-        WHERE pr.product_id = %s AND p.status = %s
-        ORDER BY pr.score DESC
-        LIMIT 4
-    ''', (product_id, 'active'))
-    recommendations = cursor.fetchall()
+    # Get recommendations (rendered strip is cached per product)
+    def load_recommendations():
+        cursor.execute('''
+            SELECT p.* FROM products p
+            INNER JOIN product_recommendations pr ON p.id = pr.recommended_product_id
+            WHERE pr.product_id = %s AND p.status = %s AND pr.recommendation_type <> 'trending'
+            ORDER BY pr.score DESC
+            LIMIT 4
+        ''', (product_id, 'active'))
+        return {'recommendations': cursor.fetchall()}
+    
+    recommendation_strip = cached_fragment(('recommendations', product_id, get_catalog_version()),
+                                           'partials/recommendations.html', load_recommendations)
     
     conn.commit()
     conn.close()
     
-    return render_template('product.html', product=product, recommendations=recommendations)
+    return render_template('product.html', product=product, recommendation_strip=recommendation_strip)
 
 @app.route('/cart')
+@admission_controlled('browse')
 def view_cart():
     """View shopping cart"""
     cart = session.get('cart', {})
@@ -259,6 +1804,7 @@ def view_cart():
     return render_template('cart.html', cart_items=cart_items, total=total)
 
 @app.route('/add-to-cart/<int:product_id>', methods=['POST'])
+@admission_controlled('browse')
 def add_to_cart(product_id):
     """Add product to cart"""
     quantity = int(request.form.get('quantity', 1))
@@ -307,6 +1853,7 @@ def update_cart(product_id):
         cart.pop(product_id_str, None)
     
     session['cart'] = cart
+    release_cart_reservation(product_id_str)
     flash('Cart updated', 'success')
     return redirect(url_for('view_cart'))
 
@@ -316,10 +1863,12 @@ def remove_from_cart(product_id):
     cart = session.get('cart', {})
     cart.pop(str(product_id), None)
     session['cart'] = cart
+    release_cart_reservation(str(product_id))
     flash('Item removed from cart', 'success')
     return redirect(url_for('view_cart'))
 
 @app.route('/checkout')
+@admission_controlled('browse')
 def checkout():
     """Checkout page"""
     cart = session.get('cart', {})
@@ -328,6 +1877,11 @@ def checkout():
         flash('Your cart is empty', 'error')
         return redirect(url_for('home'))
     
+    # Hold stock while the customer fills in the checkout form
+    reservations = reserve_cart(cart)
+    if len(reservations) < len(cart):
+        flash('Some items in your cart are no longer available in the requested quantity', 'error')
+    
     cart_items = []
     total = Decimal('0.00')
     
@@ -351,6 +1905,7 @@ def checkout():
     return render_template('checkout.html', cart_items=cart_items, total=total)
 
 @app.route('/place-order', methods=['POST'])
+@admission_controlled('order')
 def place_order():
     """Place order"""
     cart = session.get('cart', {})
@@ -374,11 +1929,14 @@ def place_order():
     total = Decimal('0.00')
     order_items = []
     
-    # Validate stock and calculate total
+    # Stock is validated by the reservations held since checkout (renewed if expired)
+    reservations = reserve_cart(cart)
     for product_id, quantity in cart.items():
+        if product_id not in reservations:
+            continue
         cursor.execute('SELECT * FROM products WHERE id = %s', (product_id,))
         product = cursor.fetchone()
-        if product and product['stock'] >= quantity:
+        if product:
             item_total = Decimal(str(product['price'])) * quantity
             total += item_total
             order_items.append({
@@ -386,7 +1944,8 @@ def place_order():
                 'product_name': product['name'],
                 'quantity': quantity,
                 'price': product['price'],
-                'subtotal': item_total
+                'subtotal': item_total,
+                'reservation_id': reservations[product_id]
             })
     
     if not order_items:
@@ -396,43 +1955,55 @@ def place_order():
     
     # Create order
     order_number = generate_order_number()
-    cursor.execute('''
-        INSERT INTO orders 
-        (order_number, customer_name, customer_email, customer_phone, total_amount, 
-         status, payment_status, shipping_address)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    ''', (order_number, customer_name, customer_email, customer_phone, total, 
-          'confirmed', 'paid', shipping_address))
-    
-    order_id = cursor.lastrowid
-    
-    # Create order items and update stock
-    for item in order_items:
+    try:
         cursor.execute('''
-            INSERT INTO order_items 
-            (order_id, product_id, product_name, quantity, price, subtotal)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        ''', (order_id, item['product_id'], item['product_name'], item['quantity'], 
-              item['price'], item['subtotal']))
+            INSERT INTO orders 
+            (order_number, customer_name, customer_email, customer_phone, total_amount, 
+             status, payment_status, shipping_address)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ''', (order_number, customer_name, customer_email, customer_phone, total, 
+              'confirmed', 'paid', shipping_address))
         
-        # Update inventory
-        update_inventory(item['product_id'], -item['quantity'], 'sale', 'order', order_id, 
-                        f"Order {order_number}")
+        order_id = cursor.lastrowid
         
-        # Update purchase count
-        cursor.execute('UPDATE products SET purchases = purchases + %s WHERE id = %s',
-                      (item['quantity'], item['product_id']))
+        # Create order items
+        for item in order_items:
+            cursor.execute('''
+                INSERT INTO order_items 
+                (order_id, product_id, product_name, quantity, price, subtotal)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            ''', (order_id, item['product_id'], item['product_name'], item['quantity'], 
+                  item['price'], item['subtotal']))
+        
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        for item in order_items:
+            stock_reservations.release(item['reservation_id'])
+        raise
+    finally:
+        conn.close()
     
-    conn.commit()
-    conn.close()
+    # Update inventory only once the order exists (stock write is batched by the reservation service)
+    for item in order_items:
+        stock_reservations.confirm(item['reservation_id'], order_id, f"Order {order_number}")
+    
+    publish_order_event(order_id, order_number, customer_name, customer_email, customer_phone, total)
+    
+    # Non-critical side effects run in the background
+    job_queue.enqueue('record_purchases', {'order_id': order_id}, dedupe_key=f'record_purchases:{order_id}')
+    for item in order_items:
+        trending_tracker.record(int(item['product_id']), TRENDING_PURCHASE_WEIGHT * item['quantity'])
     
     # Clear cart
     session.pop('cart', None)
+    session.pop('reservations', None)
     
     flash(f'Order {order_number} placed successfully!', 'success')
     return redirect(url_for('order_confirmation', order_id=order_id))
 
 @app.route('/order/<int:order_id>')
+@admission_controlled('browse')
 def order_confirmation(order_id):
     """Order confirmation page"""
     conn = get_db_connection()
@@ -458,6 +2029,7 @@ def order_confirmation(order_id):
 # ============================================================================
 
 @app.route('/api/products', methods=['GET'])
+@admission_controlled('api')
 def api_products():
     """API: Get all active products"""
     conn = get_db_connection()
@@ -480,6 +2052,7 @@ def api_products():
     return jsonify({'success': True, 'products': products})
 
 @app.route('/api/product/<int:product_id>', methods=['GET'])
+@admission_controlled('api')
 def api_product_detail(product_id):
     """API: Get product details with recommendations"""
     conn = get_db_connection()
@@ -498,7 +2071,7 @@ def api_product_detail(product_id):
     cursor.execute('''
         SELECT p.* FROM products p
         INNER JOIN product_recommendations pr ON p.id = pr.recommended_product_id
-        WHERE pr.product_id = %s AND p.status = %s
+        WHERE pr.product_id = %s AND p.status = %s AND pr.recommendation_type <> 'trending'
         ORDER BY pr.score DESC
         LIMIT 4
     ''', (product_id, 'active'))
@@ -512,6 +2085,7 @@ def api_product_detail(product_id):
     return jsonify({'success': True, 'product': product, 'recommendations': recommendations})
 
 @app.route('/api/categories', methods=['GET'])
+@admission_controlled('api')
 def api_categories():
     """API: Get all product categories"""
     conn = get_db_connection()
@@ -522,7 +2096,25 @@ def api_categories():
     
     return jsonify({'success': True, 'categories': categories})
 
+@app.route('/api/trending', methods=['GET'])
+@admission_controlled('api')
+def api_trending():
+    """API: Get currently trending products"""
+    limit = min(request.args.get('limit', TRENDING_TOP_K, type=int), TRENDING_TOP_K)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    products = get_trending_products(cursor, max(limit, 1))
+    conn.close()
+    
+    for product in products:
+        product['price'] = float(product['price'])
+    
+    return jsonify({'success': True, 'products': products})
+
 @app.route('/api/order', methods=['POST'])
+@idempotent
+@admission_controlled('order')
 def api_create_order():
     """API: Create new order"""
     data = request.get_json()
@@ -545,15 +2137,18 @@ def api_create_order():
     total = Decimal('0.00')
     order_items = []
     
-    # Validate stock and calculate total
+    # Reserve stock and calculate total
     for item in items:
         product_id = item.get('product_id')
         quantity = item.get('quantity', 1)
         
         cursor.execute('SELECT * FROM products WHERE id = %s', (product_id,))
         product = cursor.fetchone()
+        reservation_id = stock_reservations.reserve(product_id, quantity) if product else None
         
-        if not product or product['stock'] < quantity:
+        if not reservation_id:
+            for reserved in order_items:
+                stock_reservations.release(reserved['reservation_id'])
             conn.close()
             return jsonify({'success': False, 'error': f'Product {product_id} not available'}), 400
         
@@ -564,34 +2159,49 @@ def api_create_order():
             'product_name': product['name'],
             'quantity': quantity,
             'price': product['price'],
-            'subtotal': item_total
+            'subtotal': item_total,
+            'reservation_id': reservation_id
         })
     
     # Create order
     order_number = generate_order_number()
-    cursor.execute('''
-        INSERT INTO orders 
-        (order_number, customer_name, customer_email, customer_phone, total_amount, 
-         status, payment_status, shipping_address)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    ''', (order_number, customer_name, customer_email, customer_phone, total, 
-          'confirmed', 'paid', shipping_address))
-    
-    order_id = cursor.lastrowid
-    
-    # Create order items and update stock
-    for item in order_items:
+    try:
         cursor.execute('''
-            INSERT INTO order_items 
-            (order_id, product_id, product_name, quantity, price, subtotal)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        ''', (order_id, item['product_id'], item['product_name'], item['quantity'], 
-              item['price'], item['subtotal']))
+            INSERT INTO orders 
+            (order_number, customer_name, customer_email, customer_phone, total_amount, 
+             status, payment_status, shipping_address)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ''', (order_number, customer_name, customer_email, customer_phone, total, 
+              'confirmed', 'paid', shipping_address))
         
-        update_inventory(item['product_id'], -item['quantity'], 'sale', 'order', order_id)
+        order_id = cursor.lastrowid
+        
+        # Create order items
+        for item in order_items:
+            cursor.execute('''
+                INSERT INTO order_items 
+                (order_id, product_id, product_name, quantity, price, subtotal)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            ''', (order_id, item['product_id'], item['product_name'], item['quantity'], 
+                  item['price'], item['subtotal']))
+        
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        for item in order_items:
+            stock_reservations.release(item['reservation_id'])
+        raise
+    finally:
+        conn.close()
     
-    conn.commit()
-    conn.close()
+    # Update inventory only once the order exists (stock write is batched by the reservation service)
+    for item in order_items:
+        stock_reservations.confirm(item['reservation_id'], order_id, f"Order {order_number}")
+    
+    publish_order_event(order_id, order_number, customer_name, customer_email, customer_phone, total)
+    job_queue.enqueue('record_purchases', {'order_id': order_id}, dedupe_key=f'record_purchases:{order_id}')
+    for item in order_items:
+        trending_tracker.record(int(item['product_id']), TRENDING_PURCHASE_WEIGHT * item['quantity'])
     
     return jsonify({
         'success': True, 
@@ -600,6 +2210,63 @@ def api_create_order():
         'total': float(total)
     })
 
+@app.route('/api/admin/products/import', methods=['POST'])
+@admin_api_required
+def api_import_products():
+    """API: Bulk import products from a JSON list"""
+    data = request.get_json(silent=True)
+    rows = data.get('products') if isinstance(data, dict) else data
+    
+    if not isinstance(rows, list) or not rows:
+        return jsonify({'success': False, 'error': 'No products to import'}), 400
+    
+    result = import_products(rows, session.get('admin_id'))
+    return jsonify({'success': not result['errors'], **result})
+
+@app.route('/api/admin/stock-sync', methods=['POST'])
+@admin_api_required
+def api_stock_sync():
+    """API: Apply a full or delta warehouse stock feed of {product_id: stock}"""
+    data = request.get_json(silent=True)
+    feed = data.get('stock') if isinstance(data, dict) and 'stock' in data else data
+    
+    if not isinstance(feed, dict) or not feed:
+        return jsonify({'success': False, 'error': 'Expected a {product_id: stock} mapping'}), 400
+    
+    stock_by_id, errors = parse_stock_feed(feed)
+    if errors:
+        return jsonify({'success': False, 'error': 'Invalid stock feed', 'errors': errors}), 400
+    
+    result = sync_stock(stock_by_id, session.get('admin_id'))
+    return jsonify({'success': True, **result})
+
+@app.route('/api/admin/product-views', methods=['GET'])
+@admin_api_required
+def api_product_views():
+    """API: Daily views and approximate unique sessions from the rollup table"""
+    days = request.args.get('days', 30, type=int)
+    product_id = request.args.get('product_id', type=int)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    query = '''
+        SELECT product_id, DATE(bucket_start) as day, views, unique_sessions
+        FROM product_view_rollups
+        WHERE granularity = 'day' AND bucket_start >= CURDATE() - INTERVAL %s DAY
+    '''
+    params = [days]
+    if product_id:
+        query += ' AND product_id = %s'
+        params.append(product_id)
+    cursor.execute(query + ' ORDER BY bucket_start, product_id', params)
+    rows = cursor.fetchall()
+    conn.close()
+    
+    for row in rows:
+        row['day'] = row['day'].isoformat()
+    
+    return jsonify({'success': True, 'views': rows})
+
 # ============================================================================
 # ADMIN PANEL ROUTES
 # ============================================================================
@@ -647,6 +2314,8 @@ def admin_logout():
 @admin_required
 def admin_dashboard():
     """Admin dashboard"""
+    # Live updates resume from here, so nothing published while rendering is missed
+    live_events_from = event_bus.last_id
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -681,7 +2350,8 @@ def admin_dashboard():
     }
     
     return render_template('admin/dashboard.html', stats=stats, 
-                         recent_orders=recent_orders, low_stock_products=low_stock_products)
+                         recent_orders=recent_orders, low_stock_products=low_stock_products,
+                         live_events_from=live_events_from)
 
 @app.route('/admin/products')
 @admin_required
@@ -708,7 +2378,7 @@ def admin_add_product():
         low_stock_threshold = request.form.get('low_stock_threshold', 10)
         
         # Handle image upload
-        image_url = 'https://via.placeholder.com/400x400?text=Product'
+        image_url = PLACEHOLDER_IMAGE_URL
         if 'image' in request.files:
             file = request.files['image']
             if file and file.filename and allowed_file(file.filename):
@@ -733,12 +2403,38 @@ def admin_add_product():
         
         conn.commit()
         conn.close()
+        bump_catalog_version()
         
         flash('Product added successfully!', 'success')
         return redirect(url_for('admin_products'))
     
     return render_template('admin/product_form.html', product=None)
 
+@app.route('/admin/product/import', methods=['GET', 'POST'])
+@admin_required
+def admin_import_products():
+    """Bulk import products from a CSV or JSON file"""
+    result = None
+    if request.method == 'POST':
+        file = request.files.get('file')
+        if not file or not file.filename:
+            flash('Please choose a CSV or JSON file', 'error')
+            return redirect(url_for('admin_import_products'))
+        
+        try:
+            rows = parse_import_file(file)
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            flash(f'Could not read import file: {e}', 'error')
+            return redirect(url_for('admin_import_products'))
+        
+        result = import_products(rows, session.get('admin_id'))
+        if result['imported']:
+            flash(f"{result['imported']} products imported successfully!", 'success')
+        if result['errors']:
+            flash(f"{len(result['errors'])} rows skipped, see details below", 'error')
+    
+    return render_template('admin/product_import.html', result=result)
+
 @app.route('/admin/product/edit/<int:product_id>', methods=['GET', 'POST'])
 @admin_required
 def admin_edit_product(product_id):
@@ -790,6 +2486,7 @@ def admin_edit_product(product_id):
         
         conn.commit()
         conn.close()
+        bump_catalog_version()
         
         flash('Product updated successfully!', 'success')
         return redirect(url_for('admin_products'))
@@ -808,13 +2505,14 @@ def admin_edit_product(product_id):
 @admin_required
 def admin_orders():
     """Admin orders list"""
+    live_events_from = event_bus.last_id
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM orders ORDER BY created_at DESC')
     orders = cursor.fetchall()
     conn.close()
     
-    return render_template('admin/orders.html', orders=orders)
+    return render_template('admin/orders.html', orders=orders, live_events_from=live_events_from)
 
 @app.route('/admin/order/<int:order_id>')
 @admin_required
@@ -857,6 +2555,89 @@ def admin_inventory():
     
     return render_template('admin/inventory.html', logs=logs)
 
+@app.route('/admin/events')
+@admin_required
+def admin_events():
+    """Server-sent events: new orders, stock changes and low-stock crossings"""
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        position = int(last_id) if last_id else event_bus.last_id
+    except ValueError:
+        position = event_bus.last_id
+    
+    def generate(position):
+        yield 'retry: 3000\n\n'
+        while True:
+            events = event_bus.wait(position, SSE_KEEPALIVE)
+            if events is None:
+                # Too far behind to replay; the page reloads itself
+                position = event_bus.last_id
+                yield f'id: {position}\nevent: reset\ndata: {{}}\n\n'
+            elif not events:
+                yield ': keepalive\n\n'
+            for event_id, event_type, data in events or []:
+                position = event_id
+                yield f'id: {event_id}\nevent: {event_type}\ndata: {data}\n\n'
+    
+    return Response(generate(position), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def admin_export(name, query, date_column, columns):
+    """Validate export parameters and start streaming"""
+    fmt = request.args.get('format', 'csv')
+    try:
+        start, end = parse_export_range(request.args)
+    except ValueError:
+        flash('Invalid date range, use YYYY-MM-DD', 'error')
+        return redirect(url_for('admin_orders' if name == 'orders' else 'admin_inventory'))
+    if fmt not in ('csv', 'ndjson'):
+        flash('Export format must be csv or ndjson', 'error')
+        return redirect(url_for('admin_orders' if name == 'orders' else 'admin_inventory'))
+    
+    conditions = ['1 = 1']
+    params = []
+    if start:
+        conditions.append(f'{date_column} >= %s')
+        params.append(start)
+    if end:
+        conditions.append(f'{date_column} < %s')
+        params.append(end)
+    
+    filename = f"{name}_{request.args.get('start') or 'all'}_{request.args.get('end') or 'now'}"
+    return stream_export(query.format(where=' AND '.join(conditions)), params, columns, fmt, filename)
+
+@app.route('/admin/export/orders')
+@admin_required
+def admin_export_orders():
+    """Export orders for a date range as CSV or NDJSON"""
+    return admin_export('orders', '''
+        SELECT id, order_number, customer_name, customer_email, customer_phone, total_amount,
+               status, payment_status, shipping_address, created_at
+        FROM orders
+        WHERE {where}
+        ORDER BY created_at
+    ''', 'created_at', ['id', 'order_number', 'customer_name', 'customer_email', 'customer_phone',
+                        'total_amount', 'status', 'payment_status', 'shipping_address', 'created_at'])
+
+@app.route('/admin/export/inventory')
+@admin_required
+def admin_export_inventory():
+    """Export the inventory log for a date range as CSV or NDJSON"""
+    return admin_export('inventory', '''
+        SELECT il.id, il.created_at, il.product_id, p.name as product_name, il.change_type,
+               il.quantity_change, il.previous_stock, il.new_stock, il.reference_type,
+               il.reference_id, il.notes, au.username as admin_username
+        FROM inventory_log il
+        LEFT JOIN products p ON il.product_id = p.id
+        LEFT JOIN admin_users au ON il.created_by = au.id
+        WHERE {where}
+        ORDER BY il.created_at
+    ''', 'il.created_at', ['id', 'created_at', 'product_id', 'product_name', 'change_type',
+                           'quantity_change', 'previous_stock', 'new_stock', 'reference_type',
+                           'reference_id', 'notes', 'admin_username'])
+
 # ============================================================================
 # UTILITY ROUTES
 # ============================================================================
@@ -902,4 +2683,5 @@ def currency_filter(value):
 # ============================================================================
 
 if __name__ == '__main__':
+    job_queue.start()
     app.run(host='0.0.0.0', port=8080, debug=False)
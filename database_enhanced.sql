@@ -84,6 +84,13 @@ CREATE TABLE order_items (
     INDEX idx_product_id (product_id)
 );
 
+-- Orders already added to products.purchases by the record_purchases job
+CREATE TABLE purchase_counted_orders (
+    order_id INT PRIMARY KEY,
+    counted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE
+);
+
 -- ============================================================================
 -- INVENTORY LOG TABLE
 -- ============================================================================
@@ -119,6 +126,36 @@ CREATE TABLE product_views (
     INDEX idx_viewed_at (viewed_at)
 );
 
+-- ============================================================================
+-- PRODUCT VIEW ROLLUPS (Hourly/daily aggregates of product_views)
+-- ============================================================================
+CREATE TABLE product_view_rollups (
+    product_id INT NOT NULL,
+    granularity ENUM('hour', 'day') NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    views INT NOT NULL DEFAULT 0,
+    unique_sessions INT NOT NULL DEFAULT 0,
+    sessions_sketch VARBINARY(1024),  -- kept on daily rows; hourly sketches are cleared once their day is final
+    PRIMARY KEY (product_id, granularity, bucket_start),
+    INDEX idx_bucket (granularity, bucket_start)
+);
+
+-- Raw views moved out of product_views by the retention job (VIEW_RETENTION_ARCHIVE)
+CREATE TABLE product_views_archive (
+    id INT PRIMARY KEY,
+    product_id INT NOT NULL,
+    session_id VARCHAR(100),
+    ip_address VARCHAR(50),
+    viewed_at TIMESTAMP NULL,
+    INDEX idx_viewed_at (viewed_at)
+);
+
+-- Progress markers for background analytics jobs
+CREATE TABLE analytics_watermarks (
+    name VARCHAR(100) PRIMARY KEY,
+    value DATETIME NOT NULL
+);
+
 -- ============================================================================
 -- PRODUCT RECOMMENDATIONS TABLE
 -- ============================================================================